@@ -28,35 +28,48 @@ usage: depends.py [options] [input-dir]
 import sys
 import os
 import re
-import getopt
+import argparse
+import functools
+import concurrent.futures
+import collections
+import contextlib
+import mmap
+import shutil
+import subprocess
 import platform
 
 # File types to scan directly.
-CPP_FILE_TYPES = [ '.c', '.cpp', '.cxx' ]
+CPP_FILE_TYPES = frozenset([ '.c', '.cpp', '.cxx' ])
 
 # Regular expressions to match include directives.
-CPP_INC_PATTERN = re.compile( '# *include *([<"])([^>"]*)([>"])' )
+CPP_INC_PATTERN = re.compile( rb'^[ \t]*#[ \t]*include[ \t]*([<"])([^>"\r\n]*)([>"])', re.MULTILINE )
 
 # System header files include paths.
-SYS_INC_PATHS = []
+SYS_INC_PATHS = ()
 
 # List of file types to ignore
-IGNORE_LIST = [ '.git' ]
+IGNORE_LIST = frozenset([ '.git' ])
 
 # Constants.
-MAX_DEPTH = 1000
 INDENT = 2
+MMAP_MIN_SIZE = 64 * 1024
+
+# Node flags.
+HAS_PARENT = 1
+VISITED = 2
+MISSING = 4
+
+# Byte translation table clearing the VISITED flag.
+CLEAR_VISITED = bytes(flags & ~VISITED for flags in range(256))
 
 # Globals.
 graph = None
 verbose = False
 output_format = 'txt'
-depth = 0
-max_depth_reached = 0
 
 # Array of include search paths if your code uses #include <filename> style
 # file inclusion.
-inc_search_paths = []
+inc_search_paths = ()
 
 ##############################################################################
 
@@ -65,284 +78,603 @@ def log(s):
         print(s)
 
 def error(s):
-    print('ERROR: ' + s)
-
-def usage():
-    print(
-    'usage: depends [options]\r\n\r\n' +
-    'Options are:\r\n' +
-    '    -h             print this help and exit\r\n' +
-    '    -i             specify input directory\r\n' +
-    '    -I             add include search path\r\n' +
-    '    -f             specify format of output file. Supported are txt, html\r\n' +
-    '    -o             specify output file name to create (default is stdout)\r\n' +
-    '    -v             enable verbose mode\r\n' +
-    '    --node         print depedencies of node\r\n' +
-    '    --top-level    print top level files only\r\n' +
-    '    --leaf-level   print leaf level files only\r\n\r\n' +
-
-    'If "input-dir" is not specified, depends will scan current directory.\r\n'
-    )
+    print(f'ERROR: {s}')
+
+def make_arg_parser():
+    parser = argparse.ArgumentParser(
+        prog='depends',
+        description='Dependency graph generator for C/C++.',
+        epilog='If "input-dir" is not specified, depends will scan current directory.')
+    parser.add_argument('input_dir', metavar='input-dir', nargs='?',
+        help='directory to scan')
+    parser.add_argument('-i', dest='input', metavar='dir',
+        help='specify input directory')
+    parser.add_argument('-I', dest='inc_paths', metavar='dir', action='append', default=[],
+        help='add include search path')
+    parser.add_argument('-f', dest='format', metavar='format', default='txt',
+        help='specify format of output file. Supported are txt, html')
+    parser.add_argument('-o', dest='output', metavar='file',
+        help='specify output file name to create (default is stdout)')
+    parser.add_argument('-v', dest='verbose', action='store_true',
+        help='enable verbose mode')
+    parser.add_argument('--node',
+        help='print depedencies of node')
+    level = parser.add_mutually_exclusive_group()
+    level.add_argument('--top-level', action='store_true',
+        help='print top level files only')
+    level.add_argument('--leaf-level', action='store_true',
+        help='print leaf level files only')
+    return parser
 
 """
-Node class.  Defines an object representing a node in the dependency graph.
+Node class.  Defines a handle to a node in the dependency graph. Node data
+is stored in arrays on the Graph, indexed by the node id.
 """
 class Node(object):
-    def __init__(self, file):
-        self.file = file
-        self.children = []
-        self.has_parent = False
-        self.visited = False
-        self.missing = False
-        return
-
-    def get_file(self):
-        return self.file
-
-    def add_child(self, node):
-        for node_ in self.children:
-            if node_ == node:
-                return
-        self.children.append(node)
-        node.has_parent = True
+    # Handles are created on every lookup so they carry no instance dict.
+    __slots__ = ('graph', 'id')
 
-    def has_child(self, node):
-        if node in self.children:
-            return True
-        return False
+    def __init__(self, graph, id):
+        self.graph = graph
+        self.id = id
 
-    def has_children(self):
-        return len(self.children) > 0
+    def get_flag(self, flag):
+        return (self.graph.flags[self.id] & flag) != 0
 
-    def get_children(self):
-        return self.children
+    def set_flag(self, flag, value):
+        if value:
+            self.graph.flags[self.id] |= flag
+        else:
+            self.graph.flags[self.id] &= ~flag
 
-    def print_node(self):
-        s = self.file
+    @property
+    def file(self):
+        return self.graph.paths[self.id]
 
-        # Remove "./" prefix in path, if any.
-        if s.startswith('./') or s.startswith('.\\'):
-            s = s[2:]
+    @property
+    def has_parent(self):
+        return self.get_flag(HAS_PARENT)
 
-        # Indent by current depth.
-        for i in range(0, depth * INDENT):
-            s = ' ' + s
-        if self.visited:
-            s = s + ' *'
-        if self.missing:
-            s = s + ' ?'
+    @has_parent.setter
+    def has_parent(self, value):
+        self.set_flag(HAS_PARENT, value)
 
-        print(s)
+    @property
+    def visited(self):
+        return self.get_flag(VISITED)
 
-    def print_tree(self):
-        global depth, max_depth_reached
-        
-        if depth > MAX_DEPTH:
-            print('MAX depth reached ' + str(depth))
-            return False
+    @visited.setter
+    def visited(self, value):
+        self.set_flag(VISITED, value)
 
-        self.print_node()
+    @property
+    def missing(self):
+        return self.get_flag(MISSING)
 
-        if self.visited:
-            return
-        self.visited = True
+    @missing.setter
+    def missing(self, value):
+        self.set_flag(MISSING, value)
 
-        depth = depth + 1
-        max_depth_reached = depth
-        
-        for child in self.children:
-            if not child.print_tree():
-                return False
-        depth = depth - 1
+    def get_file(self):
+        return self.file
 
-        return True
+    def add_child(self, node):
+        self.graph.add_edge(self.id, node.id)
 
 """
 Graph class.  Defines an object representing a module dependency graph.
+Nodes are interned by canonical path and stored as parallel arrays: paths[id]
+is the file as first spelled, children[id] the list of child ids and
+flags[id] a bit set of the HAS_PARENT, VISITED and MISSING flags.
 """
 class Graph(object):
     def __init__(self):
-        self.nodes = {}
+        self.ids = {}
+        self.paths = []
+        self.children = []
+        self.flags = bytearray()
+        self.edges = set()
 
     def get_node(self, file):
-        if not file in self.nodes:
-            self.nodes[file] = Node(file)
-        return self.nodes[file]
+        id = self.ids.setdefault(canonical_path(file), len(self.paths))
+        if id == len(self.paths):
+            self.paths.append(file)
+            self.children.append([])
+            self.flags.append(0)
+        return Node(self, id)
+
+    def has_node(self, file):
+        return canonical_path(file) in self.ids
+
+    def get_missing(self):
+        return [self.paths[id] for id in range(len(self.paths)) if self.flags[id] & MISSING]
+
+    def add_edge(self, parent, child):
+        # Edges are also kept in a set for constant time duplicate checks.
+        if (parent, child) in self.edges:
+            return
+        self.edges.add((parent, child))
+        self.children[parent].append(child)
+        self.flags[child] |= HAS_PARENT
+
+    def format_node(self, id, depth):
+        s = self.paths[id]
 
-    def get_nodes(self):
-        return self.nodes
+        # Remove "./" prefix in path, if any.
+        if s.startswith('./') or s.startswith('.\\'):
+            s = s[2:]
+
+        # Indent by given depth.
+        s = ' ' * (depth * INDENT) + s
+        flags = self.flags[id]
+        if flags & VISITED:
+            s = s + ' *'
+        if flags & MISSING:
+            s = s + ' ?'
+
+        return s + '\n'
+
+    def print_subtree(self, out, id, depth=0):
+        # Walk the tree depth first using an explicit stack of (id, depth)
+        # pairs. Children are pushed in reverse to print them in order. A
+        # node already printed is marked with '*' and not expanded again.
+        # Returns the maximum depth reached.
+        children = self.children
+        flags = self.flags
+        max_depth = depth
+        stack = [(id, depth)]
+        while stack:
+            id, depth = stack.pop()
+            out.append(self.format_node(id, depth))
+            if depth > max_depth:
+                max_depth = depth
+
+            if flags[id] & VISITED:
+                continue
+            flags[id] |= VISITED
+
+            for child in reversed(children[id]):
+                stack.append((child, depth + 1))
+
+        return max_depth
+
+    def find_cycles(self):
+        # Returns a list of include cycles, each a list of files where every
+        # file includes the next and the last one is the first again.
+        children = self.children
+        count = len(self.paths)
+
+        # Kahn's algorithm. Nodes left over once every node with no
+        # remaining parents has been drained are on or below a cycle.
+        indegree = [0] * count
+        for id in range(count):
+            for child in children[id]:
+                indegree[child] += 1
+        queue = collections.deque(id for id in range(count) if indegree[id] == 0)
+        drained = 0
+        while queue:
+            id = queue.popleft()
+            drained += 1
+            for child in children[id]:
+                indegree[child] -= 1
+                if indegree[child] == 0:
+                    queue.append(child)
+        if drained == count:
+            return []
+
+        remaining = set(id for id in range(count) if indegree[id] > 0)
+        cycles = []
+        for scc in self.find_components(remaining):
+            if len(scc) == 1 and not (scc[0], scc[0]) in self.edges:
+                continue
+            cycle = self.find_cycle(scc[0], set(scc))
+            cycle.reverse()
+            cycles.append([self.paths[id] for id in cycle])
+        return cycles
+
+    def find_components(self, ids):
+        # Tarjan's strongly connected components algorithm restricted to the
+        # given node ids, using an explicit stack of (id, child iterator)
+        # pairs instead of recursion.
+        children = self.children
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        components = []
+
+        for root in sorted(ids):
+            if root in index:
+                continue
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(children[root]))]
+            while work:
+                id, it = work[-1]
+                for child in it:
+                    if not child in ids:
+                        continue
+                    if not child in index:
+                        index[child] = low[child] = len(index)
+                        stack.append(child)
+                        on_stack.add(child)
+                        work.append((child, iter(children[child])))
+                        break
+                    elif child in on_stack:
+                        low[id] = min(low[id], index[child])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[id])
+                    if low[id] == index[id]:
+                        component = []
+                        while True:
+                            node = stack.pop()
+                            on_stack.discard(node)
+                            component.append(node)
+                            if node == id:
+                                break
+                        components.append(component)
+
+        return components
+
+    def find_cycle(self, start, ids):
+        # Breadth first search within ids for the shortest path from start
+        # back to itself. Returns the node ids along it, start at both ends.
+        parents = {}
+        queue = collections.deque([start])
+        while queue:
+            id = queue.popleft()
+            for child in self.children[id]:
+                if child == start:
+                    cycle = [start]
+                    while id != start:
+                        cycle.append(id)
+                        id = parents[id]
+                    cycle.append(start)
+                    cycle.reverse()
+                    return cycle
+                if child in ids and not child in parents:
+                    parents[child] = id
+                    queue.append(child)
+        return [start]
+
+    def print_cycles(self):
+        out = []
+        for cycle in self.find_cycles():
+            out.append(f"? cycle: {' -> '.join(cycle)}\n")
+        sys.stdout.write(''.join(out))
 
     def print_graph(self):
-        global indent
-        indent = 0
         self.clear_visisted()
-        for file in self.nodes:
-            node = self.nodes[file]
-            if not node.has_parent:
-                node.print_tree()
+        out = []
+        for id in range(len(self.paths)):
+            if not self.flags[id] & HAS_PARENT:
+                self.print_subtree(out, id)
+        sys.stdout.write(''.join(out))
 
     def print_leaf_nodes(self):
         self.clear_visisted()
-        for file in self.nodes:
-            node = self.nodes[file]
-            if node.has_children() == False:
-                node.print_node()
+        out = []
+        for id in range(len(self.paths)):
+            if not self.children[id]:
+                out.append(self.format_node(id, 0))
+        sys.stdout.write(''.join(out))
 
     def print_top_level_nodes(self):        
         self.clear_visisted()        
-        for file in self.nodes:
-            node = self.nodes[file]
-            if not node.has_parent:
-                node.print_node()
+        out = []
+        for id in range(len(self.paths)):
+            if not self.flags[id] & HAS_PARENT:
+                out.append(self.format_node(id, 0))
+        sys.stdout.write(''.join(out))
 
     def print_node(self, name):
         self.clear_visisted()
-        if name in self.nodes:
-            node = self.nodes[name]
-            node.print_tree()
+        key = canonical_path(name)
+        if key in self.ids:
+            out = []
+            self.print_subtree(out, self.ids[key])
+            sys.stdout.write(''.join(out))
         
     def clear_visisted(self):
-        global depth, max_depth_reached
-        depth = max_depth_reached = 0
-        for file in self.nodes:
-            node = self.nodes[file]
-            node.visited = False
+        # Clear the VISITED bit of every node in a single pass.
+        self.flags = self.flags.translate(CLEAR_VISITED)
 
+# Results are cached since the same headers get included from many files.
+# inc_search_paths and SYS_INC_PATHS must not change once scanning starts.
+@functools.lru_cache(maxsize=None)
 def resolve_path(dir_path, inc_path, relative):
     if relative:
         full_path = os.path.join(dir_path, inc_path)
         if os.path.isfile(full_path):
-            return full_path    
+            return full_path
     for search_path in inc_search_paths:
         full_path = os.path.join(search_path, inc_path)
         if os.path.isfile(full_path):
             return full_path
     return inc_path
 
+# Returns the key a file is stored under in the graph, so different
+# spellings of the same path or symbolic links to one file share a node.
+@functools.lru_cache(maxsize=None)
+def canonical_path(path):
+    return os.path.realpath(path)
+
+@functools.lru_cache(maxsize=None)
 def is_sys_header_path(dir_path):
-    for path in SYS_INC_PATHS:
-        if dir_path.startswith(path):
-            return True
-    return False
+    return dir_path.startswith(SYS_INC_PATHS)
     
-def cpp_scan_file(path):
-    global graph
+# Extracts the #include directives from the contents of a file, given as
+# bytes or an mmap. Returns a tuple of the (isrelative, inc_path) pairs found
+# and the error messages for any invalid directives.
+def cpp_find_includes(path, data):
+    includes = []
+    errors = []
+
+    # A plain substring search is much cheaper than the regex, so files
+    # without any include directive skip it altogether. The check is on
+    # 'include' alone since whitespace may follow the '#'.
+    if data.find(b'include') != -1:
+        matches = CPP_INC_PATTERN.finditer(data)
+    else:
+        matches = []
+
+    # Matching is done on the raw bytes since directives are plain ASCII.
+    # Only the parts that are kept get decoded. Include paths are decoded
+    # as file names so any bytes round trip to the file system.
+    for match in matches:
+        first, inc_path, last = match.group(1), match.group(2), match.group(3)
+        if ((first == b'<' and last == b'"') or (first == b'"' and last == b'>')):
+            # Line number and text are only needed here so work them out
+            # from the match offset.
+            line_num = data[:match.start()].count(b'\n') + 1
+            line_end = data.find(b'\n', match.end())
+            if line_end == -1:
+                line_end = len(data)
+            line = data[data.rfind(b'\n', 0, match.start()) + 1:line_end]
+            line = line.decode('utf-8', 'replace')
+            errors.append(f'{path}: Invalid #include directive at line {line_num}: {line.strip()}')
+        else:
+            includes.append((first == b'"', os.fsdecode(inc_path)))
 
-    # Create or get a node for this file.
-    this_node = graph.get_node(path)
-    if this_node.visited:
-        log('Ignoring scanned file: ' + path)
-        return
-    this_node.visited = True
+    return includes, errors
 
+# Reads a file and extracts its #include directives as cpp_find_includes
+# does, or returns None if the file is missing. Runs on worker threads so it
+# must not touch the graph.
+def cpp_read_file(path):
     if not os.path.isfile(path):
-        this_node.missing = True
-        error(path + ' is missing. Did you add include search paths?')
-        return
+        return None
 
-    dir_path,filename = os.path.split(path)
-    log('Scanning ' + path)
+    f = open(path, "rb")
+    try:
+        # Large files are mapped rather than copied into memory. Small ones
+        # are read since mapping has a fixed setup cost.
+        if os.fstat(f.fileno()).st_size > MMAP_MIN_SIZE:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return cpp_find_includes(path, data)
+            finally:
+                data.close()
+        else:
+            return cpp_find_includes(path, f.read())
+    finally:
+        f.close()
+
+# Scans the given files and the files they include into the graph. Results
+# already extracted for a file can be passed in prescanned, keyed by
+# canonical path, and the file is then not read again.
+def cpp_scan_files(paths, prescanned=None):
+    global graph
 
-    # Build list of files this file depends on.
-    includes = []
-    f = open(path, "rt")
-    line_num = 1
-    for line in f:
-        match = CPP_INC_PATTERN.match(line)
-        if match is not None:
-            first = match.groups(1)[0]
-            last = match.groups(1)[2]
-            if ((first == '<' and last == '"') or (first == '"' and last == '>')):
-                error(path + ': Invalid #include directive at line ' + str(line_num) + ': ' + line.strip())
-            else:
-                isrelative = first == '"'
-                inc_path = match.groups(1)[1]
+    if prescanned == None:
+        prescanned = {}
+
+    # Files are read on a thread pool while the graph is built on this
+    # thread. A file is submitted as soon as it is known to be needed and
+    # its result is consumed in depth first order, so the output does not
+    # depend on which read finishes first. Futures are keyed by canonical
+    # path so each file is read only once.
+    futures = {}
+    submitted = set()
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+
+        def submit(path):
+            key = canonical_path(path)
+            if not key in submitted:
+                submitted.add(key)
+                if key in prescanned:
+                    futures[key] = concurrent.futures.Future()
+                    futures[key].set_result(prescanned[key])
+                else:
+                    futures[key] = executor.submit(cpp_read_file, path)
+
+        for path in paths:
+            submit(path)
+
+        # Scan files using a stack of paths to visit rather than recursing
+        # into each included file.
+        stack = list(reversed(paths))
+        while stack:
+            path = stack.pop()
+
+            # Create or get a node for this file.
+            this_node = graph.get_node(path)
+            if this_node.visited:
+                if verbose:
+                    log(f'Ignoring scanned file: {path}')
+                continue
+            this_node.visited = True
+
+            # Missing files are reported together once the scan is done.
+            result = futures.pop(canonical_path(path)).result()
+            if result is None:
+                this_node.missing = True
+                continue
+
+            dir_path,filename = os.path.split(path)
+            if verbose:
+                log(f'Scanning {path}')
+
+            # Build list of files this file depends on. A file included more
+            # than once is only listed the first time.
+            includes = []
+            seen = set()
+            matches, errors = result
+            for s in errors:
+                error(s)
+            for isrelative, inc_path in matches:
                 inc_path = resolve_path(dir_path, inc_path, isrelative)
+                if inc_path in seen:
+                    continue
+                seen.add(inc_path)
                 base_dir, inc_file = os.path.split(inc_path)
                 if is_sys_header_path(base_dir):
-                    log('Ignoring system header file: ' + inc_path)
+                    if verbose:
+                        log(f'Ignoring system header file: {inc_path}')
                 else:
-                    log('  ' + path + ' >> ' + inc_path)
+                    if verbose:
+                        log(f'  {path} >> {inc_path}')
                     includes.append(inc_path)
-        line_num = line_num + 1
 
-    f.close()
+            # Add this node to its parent node and queue included files to
+            # scan.
+            for inc_path in includes:
+                include_node = graph.get_node(inc_path)
+                include_node.add_child(this_node)
+                submit(inc_path)
+            stack.extend(reversed(includes))
+
+    missing = graph.get_missing()
+    if missing:
+        error('Included files not found. Did you add include search paths?')
+        sys.stdout.write(''.join(f'  {file}\n' for file in missing))
+
+# Extracts the #include directives of every C/C++ file under dirpath with a
+# single ripgrep run. Returns a dict mapping the canonical path of each file
+# with at least one directive to a result as returned by cpp_read_file, or
+# an empty dict if ripgrep fails.
+def rg_scan_dir(dirpath):
+    # --text searches files with NUL bytes in full, as cpp_read_file does,
+    # instead of stopping at the first NUL. --encoding none and (?-u) make
+    # the pattern match raw bytes like CPP_INC_PATTERN, so paths that are not
+    # valid UTF-8 are found too. --follow walks symbolic links to
+    # directories as cpp_scan_dir does.
+    args = ['rg', '--no-config', '--no-ignore', '--hidden', '--follow',
+        '--text', '--encoding', 'none', '--null', '--line-number',
+        '--no-heading', '--color=never', '-tc', '-tcpp']
+    for ext in IGNORE_LIST:
+        args += ['-g', '!*' + ext]
+    args += ['-e', '(?-u)' + CPP_INC_PATTERN.pattern.decode('ascii'), '--', dirpath]
+
+    # Each output line is the path, a NUL, the line number, ':' and the
+    # matching line. Lines of one file are printed together and in order.
+    # Anything else, such as a warning from ripgrep, is skipped.
+    results = {}
+    with subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as proc:
+        for line in proc.stdout:
+            if not b'\0' in line:
+                continue
+            path, line = line.split(b'\0', 1)
+            if not b':' in line:
+                continue
+            line_num, line = line.split(b':', 1)
+            match = CPP_INC_PATTERN.match(line)
+            if match is None:
+                continue
+
+            path = os.fsdecode(path)
+            key = canonical_path(path)
+            if not key in results:
+                results[key] = ([], [])
+            includes, errors = results[key]
+
+            first, inc_path, last = match.group(1), match.group(2), match.group(3)
+            if ((first == b'<' and last == b'"') or (first == b'"' and last == b'>')):
+                line = line.decode('utf-8', 'replace')
+                errors.append(f"{path}: Invalid #include directive at line {line_num.decode('ascii')}: {line.strip()}")
+            else:
+                includes.append((first == b'"', os.fsdecode(inc_path)))
 
-    # Add this node to its parent node and scan files recursively.
-    for inc_path in includes:
-        include_node = graph.get_node(inc_path)
-        include_node.add_child(this_node)
-        cpp_scan_file(inc_path)
+    # Exit status 1 only means nothing matched. Any error, such as a link
+    # loop or an unreadable file, discards the results.
+    if proc.returncode > 1:
+        log('ripgrep failed, scanning files directly')
+        return {}
+    return results
 
-def cpp_scan_dir(dirpath):
-    log('Scanning dir ' + dirpath)
+def walk_error(e):
+    error(f'{e.filename}: {e.strerror}')
 
-    files = os.listdir(dirpath)
-    for file in files:
-        path = os.path.join(dirpath, file)
-        if os.path.isfile(path):
-            name,ext = os.path.splitext('x' + file)
+def cpp_scan_dir(dirpath):
+    # Walk the tree top down, pruning ignored directories before os.walk
+    # descends into them. Symbolic links to directories are followed, and
+    # directories already walked are pruned so link loops terminate. Source
+    # files are collected first and then scanned together.
+    paths = []
+    walked = set([os.path.realpath(dirpath)])
+    for root, dirs, files in os.walk(dirpath, onerror=walk_error, followlinks=True):
+        if verbose:
+            log(f'Scanning dir {root}')
+
+        subdirs = []
+        for dir in dirs:
+            name,ext = os.path.splitext('x' + dir)
             if ext in IGNORE_LIST:
-                log('Ignoring ' + file)
-            elif ext in CPP_FILE_TYPES:
-                cpp_scan_file(path)            
+                log(f'Ignoring {dir}')
+                continue
+            real_dir = os.path.realpath(os.path.join(root, dir))
+            if real_dir in walked:
+                log(f'Ignoring walked dir {dir}')
+            else:
+                walked.add(real_dir)
+                subdirs.append(dir)
+        dirs[:] = subdirs
 
-    # Recursively scan sub directories.
-    for file in files:
-        path = os.path.join(dirpath, file)
-        if os.path.isdir(path):
+        # os.walk also lists dangling symbolic links as files, so check that
+        # source files really exist.
+        for file in files:
             name,ext = os.path.splitext('x' + file)
             if ext in IGNORE_LIST:
-                log('Ignoring ' + file)
-            else:
-                cpp_scan_dir(path)            
+                log(f'Ignoring {file}')
+            elif ext in CPP_FILE_TYPES:
+                path = os.path.join(root, file)
+                if os.path.isfile(path):
+                    paths.append(path)
 
-def main(argv):
-    global verbose, inc_search_paths, output_format, graph, max_depth_reached
+    # Let ripgrep extract the directives of the whole tree in one go if it
+    # is installed. Files it has no results for are read as usual.
+    prescanned = {}
+    if shutil.which('rg') != None:
+        prescanned = rg_scan_dir(dirpath)
 
-    input_dir = '.'
-    only_top_level = False
-    only_leaf_level = False
-    node = None
-    
-    try:
-        opts, args = getopt.getopt(argv, "I:f:i:o:v", ["top-level","leaf-level","node="])
-    except getopt.GetoptError:
-        usage()
-        sys.exit(-1)
-
-    for opt, arg in opts:
-        # print(opt + ' > ' + arg)
-        if opt == '-h':
-            usage()
-            sys.exit(0)
-        elif opt == '-I':
-            inc_search_paths.append(arg)
-        elif opt == '-i':
-            input_dir = arg
-        elif opt == '-f':
-            output_format = arg
-        elif opt == '-v':
-            verbose = True
-        elif opt == '--node':
-            node = arg
-        elif opt == '--top-level':
-            only_top_level = True
-        elif opt == '--leaf-level':
-            only_leaf_level = True
-        else:
-            print('Invalid option "' + opt + '"')
-            usage()
-            sys.exit(1)
+    cpp_scan_files(paths, prescanned)
 
-    if only_top_level and only_leaf_level:
-        error("Both --top-level and --leaf-level flags present.")
-        usage()
+def main(argv):
+    global verbose, inc_search_paths, output_format, SYS_INC_PATHS
+
+    args = make_arg_parser().parse_args(argv)
+    input_dir = args.input or args.input_dir or '.'
+    search_paths = list(args.inc_paths)
+    output_format = args.format
+    verbose = args.verbose
+    node = args.node
+    only_top_level = args.top_level
+    only_leaf_level = args.leaf_level
+
+    if not os.path.isdir(input_dir):
+        error(f'{input_dir} is not a directory.')
         sys.exit(1)
 
     # Build paths for system headers.
+    sys_inc_paths = []
     if sys.platform in ['cygwin', 'linux2', 'darwin']:
-        SYS_INC_PATHS.append('/usr/include')
+        sys_inc_paths.append('/usr/include')
         
     # Add windows headers path to system includes.
     # TODO: Better way to do this instead of guessing.
@@ -353,7 +685,7 @@ def main(argv):
             'C:\\Program Files\\Microsoft SDKs\\Windows\\v7.0A\\Include'
             ]:
             if os.path.isdir(path):
-                SYS_INC_PATHS.append(path)
+                sys_inc_paths.append(path)
     # Add cygwin C/C++ library header paths to system includes.
     if os.name == 'posix' and sys.platform == 'cygwin':
         for path in [
@@ -361,30 +693,59 @@ def main(argv):
             '/lib/gcc/i686-pc-cygwin/5.4.0/include/c++'
             ]:
             if os.path.isdir(path):
-                SYS_INC_PATHS.append(path)
+                sys_inc_paths.append(path)
+
+    # Add all system paths to include search path array. Both are frozen
+    # into tuples as they stay the same for the rest of the run, and the
+    # results cached from any earlier run are dropped.
+    SYS_INC_PATHS = tuple(sys_inc_paths)
+    inc_search_paths = tuple(search_paths + sys_inc_paths)
+    resolve_path.cache_clear()
+    is_sys_header_path.cache_clear()
+    canonical_path.cache_clear()
+
+    # All output goes to the -o file if given, else stdout. File names that
+    # are not valid in the output encoding are written back as their
+    # original bytes rather than failing the run. stdout is restored once
+    # done.
+    if args.output != None:
+        with open(args.output, 'w', errors='surrogateescape') as f:
+            with contextlib.redirect_stdout(f):
+                run(input_dir, node, only_top_level, only_leaf_level)
+    elif hasattr(sys.stdout, 'reconfigure'):
+        errors = sys.stdout.errors
+        sys.stdout.reconfigure(errors='surrogateescape')
+        try:
+            run(input_dir, node, only_top_level, only_leaf_level)
+        finally:
+            sys.stdout.reconfigure(errors=errors)
+    else:
+        run(input_dir, node, only_top_level, only_leaf_level)
 
-    # Add all system paths to include search path array.
-    for path in SYS_INC_PATHS:
-        inc_search_paths.append(path)
+def run(input_dir, node, only_top_level, only_leaf_level):
+    global graph
 
     # Do some logging
-    log('os.name = ' + os.name)
-    log('sys.platform = ' + sys.platform)
+    log(f'os.name = {os.name}')
+    log(f'sys.platform = {sys.platform}')
     log('system includes:')
     for path in SYS_INC_PATHS:
-        log('  ' + path)
+        log(f'  {path}')
 
     # Create a graph object and beginning scanning input dir.
     graph = Graph()
     cpp_scan_dir(input_dir)
     log('Scan complete.')
 
+    # Report include cycles, if any.
+    graph.print_cycles()
+
     # Print results.
     
     # If node is specified only print its dependencies    
     if node != None:
-        print(node + ' dependencies:')
-        if node in graph.get_nodes():
+        print(f'{node} dependencies:')
+        if graph.has_node(node):
             graph.print_node(node)
         else:
             print('[none]')